@@ -0,0 +1,65 @@
+""" This program times the rank matchers against TEMPLATE_MATCHING on the game images """
+
+### Import necessary packages
+import os
+import sys
+import time
+import cv2
+import numpy as np
+import cards
+
+### Constants
+rank_path = "card_images"
+game_path = "game_images"
+repeats = 20
+
+### Main code body
+
+# Matchers to compare, from the command line or HOG by default
+match_methods = sys.argv[1:] if len(sys.argv) > 1 else [cards.HOG_MATCHING]
+
+# Load the card rank images into a list of rank objects
+ranks = cards.load_ranks(rank_path)
+
+# Find and process every card in the game images
+frames = []
+for file_name in sorted(os.listdir(game_path)):
+    img = cv2.imread(os.path.join(game_path, file_name))
+
+    all_cards = cards.findCards(img)
+    for i in range(len(all_cards)):
+        all_cards[i].processCard(img)
+
+    # Keep the cards that have a rank image to match
+    all_cards = [this_card for this_card in all_cards if len(this_card.rank_img) != 0]
+    if len(all_cards) != 0:
+        frames.append(all_cards)
+
+num_cards = sum(len(all_cards) for all_cards in frames)
+print('{} cards in {} images'.format(num_cards, len(frames)))
+
+# Best rank of every card with the reference matcher
+reference = None
+
+for match_method in [cards.TEMPLATE_MATCHING] + match_methods:
+
+    # Compile the matcher before timing
+    start = time.time()
+    this_matcher = cards.get_matcher(match_method, ranks)
+    compile_time = time.time() - start
+
+    start = time.time()
+    for _ in range(repeats):
+        scores = [this_matcher.score(all_cards) for all_cards in frames]
+    match_time = (time.time() - start)/repeats
+
+    # Compare the accepted matches with the reference
+    best = np.concatenate([np.argmin(s, axis=1) for s in scores])
+    accepted = np.concatenate([np.min(s, axis=1) for s in scores]) < this_matcher.max_score
+    if reference is None:
+        reference = (best, accepted)
+    both = accepted & reference[1]
+    agreement = np.mean(best[both] == reference[0][both]) if np.any(both) else float('nan')
+
+    print('{:16s} compile {:7.1f} ms   match {:6.3f} ms/card   accepted {:3d}   agreement {:.2f}'.format(
+        match_method, 1000*compile_time, 1000*match_time/num_cards, int(np.sum(accepted)), agreement))
@@ -4,7 +4,10 @@
 import cv2
 import os
 import copy
+import hashlib
 import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from matplotlib import pyplot as plt
 
 ### Constants ###
@@ -16,17 +19,155 @@ CARD_MIN_AREA = 2000
 CORNER_HEIGHT = 80
 CORNER_WIDTH = 50
 
+# Height of the corner crop when the suit below the rank is also extracted
+SUIT_CORNER_HEIGHT = 125
+
 RANK_HEIGHT = 125
 RANK_WIDTH = 70
 
+RANK_NAMES = ['Ace', 'Two', 'Three', 'Four', 'Five', 'Six', 'Seven', 'Eight', 'Nine', 'Ten', 'Jack', 'Queen', 'King']
+
+SUIT_HEIGHT = 100
+SUIT_WIDTH = 70
+
+# Smallest area of a piece of the suit, as a fraction of the largest piece, so that stems which
+# separate from the suit at the threshold are still cropped with it
+SUIT_PART_RATIO = 0.02
+
+SUIT_NAMES = ['Spades', 'Hearts', 'Diamonds', 'Clubs']
+
 # Polymetric approximation accuracy scaling factor
 POLY_ACC_CONST = 0.02
 
-# Matching algorithms
-HU_MOMENTS = 0
-TEMPLATE_MATCHING = 1
+# Matching algorithms, by the name of their registered matcher
+HU_MOMENTS = 'hu_moments'
+TEMPLATE_MATCHING = 'template'
+BINARY_MATCHING = 'binary'
+COARSE_TO_FINE = 'coarse_to_fine'
+EARLY_ABANDON = 'early_abandon'
+PCA_MATCHING = 'pca'
+GALLERY_MATCHING = 'gallery'
+CHAMFER_MATCHING = 'chamfer'
+SHIFT_MATCHING = 'shift'
+LINEAR_MATCHING = 'linear'
+HOG_MATCHING = 'hog'
+PROFILE_MATCHING = 'profile'
 
 MAX_MATCH_SCORE = 1500
+MAX_CHAMFER_SCORE = 3.5
+MAX_SUIT_SCORE = 700
+
+# Linear classifier scores are one minus the probability of the rank. Rank images further than
+# MAX_LINEAR_RESIDUAL from every template, as a mean difference of the downsampled images in [0, 1],
+# are not ranks at all and are rejected whatever the classifier says
+MAX_LINEAR_SCORE = 0.5
+MAX_LINEAR_RESIDUAL = 0.19
+
+# PCA matching keeps the nearest of many shifted and scaled copies of each template, which lowers every
+# score below the TEMPLATE_MATCHING scale, so it has its own threshold
+MAX_PCA_SCORE = 900
+
+# Hu moment matching scores are sums of differences of inverse moments. Hu moments are rotation and scale
+# invariant, so Six and Nine, and blank or striped crops, have the moments of some rank. A template is only
+# compared with rank images whose fraction of set pixels is within HU_MAX_FILL_DIFF of its own, and whose
+# centroid is within HU_MAX_CENTROID_DIFF of its own as a fraction of the image size. A match is accepted
+# when its score is below MAX_HU_SCORE and at most HU_RATIO of the second best
+MAX_HU_SCORE = 0.2
+HU_RATIO = 0.7
+HU_MAX_FILL_DIFF = 0.06
+HU_MAX_CENTROID_DIFF = 0.02
+
+# HOG matching scores are raw SVM outputs, which are negative for the rank. Ranks on the game images score
+# below -0.5, but crops of a lone digit or of the table still just go negative for some rank
+MAX_HOG_SCORE = -0.3
+
+# Coarse-to-fine matching downsampling factor, and number of ranks kept for full resolution matching
+COARSE_SCALE = 4
+COARSE_CANDIDATES = 3
+
+# Largest shift in pixels searched in each direction for shift matching
+SHIFT_SEARCH = 3
+
+# Number of image rows differenced at a time before checking whether to abandon a rank
+ABANDON_BLOCK_ROWS = 25
+
+# Number of dimensions rank images are projected to for PCA matching
+PCA_COMPONENTS = 20
+
+# Pixel shifts and scale factors used to augment the rank images
+AUGMENT_SHIFTS = (-2, 0, 2)
+AUGMENT_SCALES = (0.9, 1.0, 1.1)
+
+# Linear classifier weights file, and training parameters: augmented copies of each rank image,
+# gradient descent iterations and step size, and weight decay
+CLASSIFIER_PATH = os.path.join("card_images", "rank_classifier.npz")
+TRAIN_COPIES = 200
+TRAIN_ITERATIONS = 300
+TRAIN_STEP = 0.5
+TRAIN_DECAY = 1e-4
+
+# Profile matches are confident when the best profile distance is at most this fraction of the second best
+PROFILE_RATIO = 0.6
+
+# HOG descriptor window size, and SVM training parameters: augmented copies of each rank image and margin penalty
+HOG_WIDTH = 32
+HOG_HEIGHT = 64
+HOG_TRAIN_COPIES = 100
+SVM_C = 1.0
+
+# Gallery nearest neighbour index parameters: number of exemplars differenced at full resolution,
+# number of randomized KD-trees, and number of leaves visited per search
+GALLERY_NEIGHBOURS = 5
+GALLERY_TREES = 4
+GALLERY_CHECKS = 32
+FLANN_INDEX_KDTREE = 1
+
+# Rank cache size, and width and height of the downsampled rank images that are hashed
+RANK_CACHE_SIZE = 256
+HASH_WIDTH = 8
+HASH_HEIGHT = 16
+
+# Motion gating: downsampling factor of the frames compared, grayscale difference for a pixel to count
+# as changed, and number of changed downsampled pixels for the table to count as moving
+MOTION_SCALE = 8
+MOTION_THRESHOLD = 25
+MOTION_MIN_PIXELS = 4
+
+# Incremental detection: width and height of the square tiles the frame is split into, and number of
+# tiles around each changed tile that are searched again
+TILE_SIZE = 64
+TILE_MARGIN = 1
+
+# Number of frames between checks of the threshold level of the whole frame in incremental detection
+TILE_LEVEL_INTERVAL = 30
+
+# Card tracking: largest distance in pixels a card's center can move between frames and still be the same card,
+# smallest overlap (intersection over union) with the tracked card, distance it can move before it is processed
+# and matched again, and number of frames a card can go undetected before its track is dropped
+TRACK_MAX_DISTANCE = 50
+TRACK_MIN_IOU = 0.5
+TRACK_MOVE_DISTANCE = 5
+TRACK_MAX_MISSES = 5
+
+# Optical flow tracking: number of frames between full detections, largest mean intensity difference between
+# the window around a corner and where it was tracked to, downsampling factor of the tracked frames, and search
+# window size in downsampled pixels and number of pyramid levels of Lucas-Kanade optical flow. Cards are found
+# again when a corner moves further than half the window reaches at the top pyramid level, or a side of a card
+# changes length by more than FLOW_MAX_DEFORM pixels, as the corners have then locked onto something else
+FLOW_INTERVAL = 10
+FLOW_MAX_ERROR = 30
+FLOW_SCALE = 2
+FLOW_WIN_SIZE = 11
+FLOW_MAX_LEVEL = 2
+FLOW_MAX_DEFORM = 3
+
+# Threaded detection: width and height of the tiles each thread searches, and how far each tile reaches into
+# the next ones. Frames with a blob too big for the tile it starts in are searched whole on one thread
+THREAD_TILE_SIZE = 1024
+THREAD_TILE_OVERLAP = 512
+
+# Number of set bits in every possible byte, for counting differing pixels in bit-packed images
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
 
 ### Structures ###
 
@@ -35,24 +176,452 @@ class rank:
 
     def __init__(self):
         self.name = "rank_name"
+        self.deck = "" # Subdirectory of the gallery the rank image was loaded from
         self.img = [] # Thresholded image of card rank
         self.contour = [] # Contour of rank
 
+class suit:
+    """Structure to store information about each card suit."""
+
+    def __init__(self):
+        self.name = "suit_name"
+        self.img = [] # Thresholded image of card suit
+
+class rank_list(list):
+    """Structure to store the rank objects along with all rank images stacked into one array."""
+
+    def __init__(self, ranks=()):
+        list.__init__(self, ranks)
+        self.imgs = [] # Stacked (num_ranks, RANK_HEIGHT, RANK_WIDTH) array of rank images
+        self.matchers = {} # Matchers compiled for these ranks, by name
+
+class suit_list(list):
+    """Structure to store the suit objects along with all suit images stacked into one array."""
+
+    def __init__(self, suits=()):
+        list.__init__(self, suits)
+        self.imgs = [] # Stacked (num_suits, SUIT_HEIGHT, SUIT_WIDTH) array of suit images
+
+class rank_cache:
+    """Structure to store recent rank matches, keyed by the matcher that made them and a perceptual hash
+    of the rank image, so matches of one match method or rank list are never returned for another.
+    The least recently used match is evicted once max_size matches are stored."""
+
+    def __init__(self, max_size=RANK_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict() # (Matcher, rank hash) -> (best rank match, rank score, rank scores)
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, this_card, this_matcher):
+        """ Copy the match a matcher made of a card's rank image into the card. Returns True if there was one """
+
+        this_card.rank_hash = hash_rank_img(this_card.rank_img)
+        key = (this_matcher, this_card.rank_hash)
+        entry = self.entries.get(key)
+
+        if entry is None:
+            self.misses += 1
+            return False
+
+        # Mark as most recently used
+        self.entries.pop(key)
+        self.entries[key] = entry
+        self.hits += 1
+
+        (this_card.best_rank_match, this_card.rank_score, this_card.rank_scores) = entry
+        return True
+
+    def store(self, this_card, this_matcher):
+        """ Cache the match a matcher made of a card's rank image, evicting the least recently used match if full """
+
+        if this_card.rank_hash is None:
+            this_card.rank_hash = hash_rank_img(this_card.rank_img)
+
+        key = (this_matcher, this_card.rank_hash)
+        self.entries.pop(key, None)
+        self.entries[key] = (this_card.best_rank_match, this_card.rank_score, copy.copy(this_card.rank_scores))
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        """ Remove every cached match and reset the counters """
+
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+class table_roi:
+    """Structure to store the play area of the table: a mask of the camera image that is nonzero
+    where cards are searched for, and the bounding rectangle the image is cropped to."""
+
+    def __init__(self, mask):
+        self.mask = np.uint8(mask > 0)*255 # Play area mask of the whole camera image
+        self.rect = cv2.boundingRect(self.mask) # x, y, w, h of the play area
+        x, y, w, h = self.rect
+        self.crop_mask = self.mask[y:y+h, x:x+w] # Play area mask of the cropped image
+
+class motion_detector:
+    """Structure to detect changes between camera frames, by differencing heavily downsampled grayscale
+    copies of each frame with the last frame that was reported as changed."""
+
+    def __init__(self, scale=MOTION_SCALE, threshold=MOTION_THRESHOLD, min_pixels=MOTION_MIN_PIXELS):
+        self.scale = scale
+        self.threshold = threshold
+        self.min_pixels = min_pixels
+        self.reference = None # Downsampled grayscale frame that changes are measured from
+
+    def update(self, image):
+        """ Compare a frame with the reference frame. Returns a list of (x, y, w, h) rectangles of the
+        changed regions of the frame, which is empty if nothing moved. The first frame is all changed """
+
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        small = cv2.resize(gray, None, fx=1.0/self.scale, fy=1.0/self.scale, interpolation=cv2.INTER_AREA)
+
+        if (self.reference is None) or (self.reference.shape != small.shape):
+            self.reference = small
+            return [(0, 0, image.shape[1], image.shape[0])]
+
+        changed = np.uint8(cv2.absdiff(small, self.reference) > self.threshold)*255
+        if cv2.countNonZero(changed) < self.min_pixels:
+            return []
+
+        # Keep the frame the changes were found in, so slow changes still add up
+        self.reference = small
+
+        # Group neighbouring changed pixels into regions, and scale them back up to the full frame
+        changed = cv2.dilate(changed, np.ones((3,3), np.uint8))
+        (_, cnts, _) = cv2.findContours(changed, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        regions = []
+        for c in cnts:
+            x, y, w, h = cv2.boundingRect(c)
+            regions.append((x*self.scale, y*self.scale, w*self.scale, h*self.scale))
+
+        return regions
+
+    def reset(self):
+        """ Forget the reference frame, so the next frame is reported as all changed """
+
+        self.reference = None
+
+class tile_detector:
+    """Structure to find cards incrementally. The frame is split into tiles, and only the tiles that
+    changed since the last frame, plus a margin, are searched for cards again. Cards that do not
+    touch a changed region are kept from the last frame."""
+
+    def __init__(self, tile_size=TILE_SIZE, margin=TILE_MARGIN, threshold=MOTION_THRESHOLD, min_pixels=MOTION_MIN_PIXELS,
+                 level_interval=TILE_LEVEL_INTERVAL):
+        self.tile_size = tile_size
+        self.margin = margin
+        self.threshold = threshold
+        self.min_pixels = min_pixels
+        self.level_interval = level_interval
+        self.reference = None # Grayscale frame that changes are measured from, updated per tile
+        self.level = None # Threshold level of the whole frame from Otsu's method
+        self.frames = 0 # Number of frames since the threshold level was checked
+        self.cards = [] # Cards found so far
+        self.new_cards = [] # Cards found in the last frame, which still need to be processed and matched
+
+    def update(self, image):
+        """ Find the cards in a frame, searching only the regions that changed since the last frame.
+        Returns the list of all cards, kept and new """
+
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        (h, w) = gray.shape
+
+        # Check the threshold level of the whole frame every so often, since the lighting can change
+        level = self.level
+        self.frames += 1
+        if (self.reference is None) or (self.reference.shape != gray.shape) or (self.frames >= self.level_interval):
+            blur = cv2.GaussianBlur(gray, (5,5), 0)
+            (level, _) = cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY+cv2.THRESH_OTSU)
+            self.frames = 0
+
+        # Search the whole frame the first time, and when the threshold level has changed
+        if (self.reference is None) or (self.reference.shape != gray.shape) or (level != self.level):
+            self.level = level
+            self.reference = gray
+            self.cards = detect_cards(image, level=self.level)
+            self.new_cards = self.cards
+            return self.cards
+
+        # Count the changed pixels in each tile from the integral image of the changed pixels
+        (_, changed) = cv2.threshold(cv2.absdiff(gray, self.reference), self.threshold, 1, cv2.THRESH_BINARY)
+        rows = np.append(np.arange(0, h, self.tile_size), h)
+        cols = np.append(np.arange(0, w, self.tile_size), w)
+        integral = cv2.integral(changed)
+        corners = integral[np.ix_(rows, cols)]
+        counts = corners[1:, 1:] - corners[:-1, 1:] - corners[1:, :-1] + corners[:-1, :-1]
+        dirty = np.uint8(counts >= self.min_pixels)
+
+        self.new_cards = []
+        if not dirty.any():
+            return self.cards
+
+        # Only move the reference forward in the changed tiles, so slow changes still add up
+        dirty_px = np.repeat(np.repeat(dirty, self.tile_size, axis=0), self.tile_size, axis=1)[:h, :w]
+        np.copyto(self.reference, gray, where=dirty_px > 0)
+
+        # Grow the changed tiles by the margin and group them into rectangular regions
+        grown = cv2.dilate(dirty, np.ones((2*self.margin+1, 2*self.margin+1), np.uint8))
+        (_, cnts, _) = cv2.findContours(grown, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        regions = [tile_rect(cv2.boundingRect(c), self.tile_size, (h, w)) for c in cnts]
+
+        # Cards with changed pixels around them have moved, so grow the regions to cover their tiles
+        # and a tile around them, and search them again. Cards a region holds the whole of will also be found
+        # again, and the rest are kept
+        ts = self.tile_size
+        moved = []
+        kept = []
+        for this_card in self.cards:
+            (x, y, cw, ch) = cv2.boundingRect(this_card.contour)
+
+            # Count the changed pixels within the reach of the blur around the card
+            (x0, y0, x1, y1) = (max(x-2, 0), max(y-2, 0), min(x+cw+2, w), min(y+ch+2, h))
+            count = integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+            if count >= self.min_pixels:
+                moved.append(tile_cover((x, y, cw, ch), ts, (h, w)))
+            else:
+                kept.append(this_card)
+        regions = merge_rects(regions + moved)
+
+        # Grow the regions until they hold the whole of every bright blob reaching into them, apart from
+        # kept cards, since a card can be split from or joined to a blob that changed without changing itself
+        kept_rects = [cv2.boundingRect(c.contour) for c in kept]
+        threshes = {} # Region -> thresholded region
+        while True:
+            grow = []
+            for region in regions:
+                if region not in threshes:
+                    threshes[region] = self.threshold_region(gray, region)
+                for (x, y, bw, bh) in cut_blobs(threshes[region], region, (h, w)):
+                    if not any(rect_inside((x, y, bw, bh), r) for r in kept_rects):
+                        grow.append(tile_cover((x, y, bw, bh), ts, (h, w)))
+            if not grow:
+                break
+            regions = merge_rects(regions + grow)
+
+        kept = [c for c in kept if not any(rect_holds(r, cv2.boundingRect(c.contour), (h, w)) for r in regions)]
+
+        # Search each region for cards, and map them back into the full frame. Cards the region does not
+        # hold the whole of are kept ones that only reach into it
+        for region in regions:
+            (x, y, rw, rh) = region
+            for this_card in find_card_contours(threshes[region]):
+                (cx, cy, cw, ch) = cv2.boundingRect(this_card.contour)
+                if not rect_holds(region, (x+cx, y+cy, cw, ch), (h, w)):
+                    continue
+                this_card.contour = this_card.contour + np.int32([x, y])
+                this_card.corner_pts = this_card.corner_pts + np.float32([x, y])
+                self.new_cards.append(this_card)
+
+        self.cards = kept + self.new_cards
+        return self.cards
+
+    def threshold_region(self, gray, region):
+        """ Blur and threshold an (x, y, w, h) region of a grayscale frame at the threshold level """
+
+        (x, y, rw, rh) = region
+        blur = cv2.GaussianBlur(gray[y:y+rh, x:x+rw], (5,5), 0)
+        (_, thresh) = cv2.threshold(blur, self.level, 255, cv2.THRESH_BINARY)
+
+        return thresh
+
+    def reset(self):
+        """ Forget the reference frame, threshold level and cards, so the whole of the next frame is searched """
+
+        self.reference = None
+        self.level = None
+        self.frames = 0
+        self.cards = []
+        self.new_cards = []
+
+class card_tracker:
+    """Structure to follow cards from frame to frame. Each card found is associated with the tracked card
+    it overlaps most, and keeps its track ID. Cards that have not moved keep the processed images and
+    matches of the tracked card, so only new and moved cards are processed and matched again."""
+
+    def __init__(self, max_distance=TRACK_MAX_DISTANCE, min_iou=TRACK_MIN_IOU, move_distance=TRACK_MOVE_DISTANCE, max_misses=TRACK_MAX_MISSES):
+        self.max_distance = max_distance
+        self.min_iou = min_iou
+        self.move_distance = move_distance
+        self.max_misses = max_misses
+        self.tracks = {} # Track ID -> last card of the track
+        self.misses = {} # Track ID -> number of frames since the card was last found
+        self.next_id = 0
+
+    def update(self, all_cards):
+        """ Associate the cards found in a frame with the tracked cards, and set their track IDs.
+        Returns the list of cards that are new or have moved, which still need to be processed and matched """
+
+        # Score every pair of tracked and found cards that are close enough by their overlap
+        ids = list(self.tracks)
+        pairs = []
+        for j, this_card in enumerate(all_cards):
+            center = np.mean(this_card.corner_pts.reshape(-1, 2), axis=0)
+            for track_id in ids:
+                track_center = np.mean(self.tracks[track_id].corner_pts.reshape(-1, 2), axis=0)
+                if np.linalg.norm(center - track_center) > self.max_distance:
+                    continue
+                iou = quad_iou(this_card.corner_pts, self.tracks[track_id].corner_pts)
+                if iou >= self.min_iou:
+                    pairs.append((iou, track_id, j))
+
+        # Take the pairs with the most overlap first, using each track and card once
+        matched = {}
+        for (iou, track_id, j) in sorted(pairs, key=lambda p : p[0], reverse=True):
+            if (track_id in matched.values()) or (j in matched):
+                continue
+            matched[j] = track_id
+            del self.misses[track_id]
+
+        # Forget tracks whose card has not been found for too long
+        for track_id in list(self.misses):
+            self.misses[track_id] += 1
+            if self.misses[track_id] > self.max_misses:
+                del self.misses[track_id]
+                del self.tracks[track_id]
+
+        pending = []
+        for j, this_card in enumerate(all_cards):
+            if j in matched:
+                this_card.track_id = matched[j]
+                old_card = self.tracks[this_card.track_id]
+
+                # Carry over everything but the contour and corners of cards that stayed put.
+                # The center stays where the card was last processed, so slow drift still adds up
+                center = np.mean(this_card.corner_pts.reshape(-1, 2), axis=0)
+                if (len(old_card.center) != 0) and (np.linalg.norm(center - old_card.center) <= self.move_distance):
+                    for key, value in vars(old_card).items():
+                        if key not in ('contour', 'corner_pts'):
+                            setattr(this_card, key, value)
+                else:
+                    pending.append(this_card)
+            else:
+                this_card.track_id = self.next_id
+                self.next_id += 1
+                pending.append(this_card)
+
+            self.tracks[this_card.track_id] = this_card
+            self.misses[this_card.track_id] = 0
+
+        return pending
+
+    def reset(self):
+        """ Forget all tracked cards """
+
+        self.tracks = {}
+        self.misses = {}
+
+class flow_tracker:
+    """Structure to follow the corners of cards between frames with pyramidal Lucas-Kanade optical flow.
+    Cards are only found with findCards every interval frames, or when a corner is lost. Corners are tracked
+    in grayscale frames downsampled by scale, as building the flow pyramids of full frames takes about as long
+    as finding the cards."""
+
+    def __init__(self, interval=FLOW_INTERVAL, max_error=FLOW_MAX_ERROR, scale=FLOW_SCALE):
+        self.interval = interval
+        self.max_error = max_error
+        self.scale = scale
+        self.lk_params = dict(winSize=(FLOW_WIN_SIZE, FLOW_WIN_SIZE), maxLevel=FLOW_MAX_LEVEL,
+                              criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03))
+        self.reach = (FLOW_WIN_SIZE//2)*2**FLOW_MAX_LEVEL*scale # Furthest a corner can be followed between frames
+        self.prev_gray = None # Downsampled grayscale image of the last frame
+        self.cards = [] # Cards being tracked
+        self.frames = 0 # Number of frames since the last full detection
+        self.detected = False # Whether the cards were found with findCards in the last frame
+
+    def update(self, image):
+        """ Move the corners and contours of the tracked cards to where they are in a new frame, or find
+        the cards again if it is time to or tracking failed. Returns the list of cards """
+
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        gray = cv2.resize(gray, None, fx=1.0/self.scale, fy=1.0/self.scale, interpolation=cv2.INTER_AREA)
+
+        self.detected = ((self.prev_gray is None) or (self.prev_gray.shape != gray.shape)
+                         or (self.frames >= self.interval) or not self.track(gray))
+        if self.detected:
+            self.cards = findCards(image)
+            self.frames = 0
+
+        self.prev_gray = gray
+        self.frames += 1
+
+        return self.cards
+
+    def track(self, gray):
+        """ Track the corners of every card from the last frame into a new downsampled grayscale frame.
+        Returns False if any corner was lost or no longer looks like it did """
+
+        if len(self.cards) == 0:
+            return True
+
+        # Track the corners of all the cards at once, in downsampled coordinates
+        pts = np.concatenate([c.corner_pts.reshape(-1, 1, 2) for c in self.cards]).astype(np.float32)
+        (new_pts, status, error) = cv2.calcOpticalFlowPyrLK(self.prev_gray, gray, pts/self.scale, None,
+                                                            **self.lk_params)
+        if (not status.all()) or (error.max() > self.max_error):
+            return False
+        new_pts *= self.scale
+
+        # Motion beyond the reach of the search is not followed, whatever the flow found
+        if np.max(np.abs(new_pts - pts)) >= self.reach:
+            return False
+
+        # Check every side of every card kept its length, pairing each corner with the one before it on its card
+        starts = np.cumsum([0] + [len(c.corner_pts) for c in self.cards])
+        prev = np.arange(len(pts)) - 1
+        prev[starts[:-1]] = starts[1:] - 1
+        sides = np.sum((new_pts - new_pts[prev])**2, axis=2)
+        prev_sides = np.sum((pts - pts[prev])**2, axis=2)
+        if np.max(np.abs(np.sqrt(sides) - np.sqrt(prev_sides))) > FLOW_MAX_DEFORM:
+            return False
+
+        # Check the tracked corners still outline a card
+        i = 0
+        for this_card in self.cards:
+            n = len(this_card.corner_pts)
+            corners = new_pts[i:i+n]
+            i += n
+            size = cv2.contourArea(corners)
+            if (size >= CARD_MAX_AREA) or (size <= CARD_MIN_AREA):
+                return False
+
+            this_card.corner_pts = corners
+            this_card.contour = np.int32(np.round(corners))
+
+        return True
+
+    def reset(self):
+        """ Forget the tracked cards, so they are found again in the next frame """
+
+        self.prev_gray = None
+        self.cards = []
+
 class card:
     """Structure to store information about cards in the camera image."""
 
     def __init__(self):
         self.contour = [] # Contour of card
+        self.track_id = None # ID of the card across frames, from a card_tracker
         self.corner_pts = [] # Corner points of card
         self.center = [] # Center point of card
         self.img = [] # 200x300, flattened, grayed, blurred image
         self.rank_img = [] # Thresholded, sized image of card's rank
         self.rank_contour = [] # Contour of the rank
+        self.rank_hu = [] # Log-scaled Hu moments of the rank image, then its fill and centroid
+        self.rank_hash = None # Perceptual hash of the rank image
+        self.suit_img = [] # Thresholded, sized image of card's suit
+        self.best_suit_match = "Unknown" # Best matched suit
+        self.suit_score = 0 # Difference between suit image and best matched train suit image
         self.best_rank_match = "Unknown" # Best matched rank
         self.rank_score = 0 # Difference between rank image and best matched train rank image
+        self.rank_scores = [] # Difference between rank image and every train rank image
 
-    def processCard(self, image):
-        """ This function takes an image and contour associated with a card and returns a top-down image of the card """
+    def processCard(self, image, find_suit=False):
+        """ This function takes an image and contour associated with a card and returns a top-down image of the card.
+        If find_suit is set, the suit below the rank is also extracted from the corner """
 
         # Find width and height of card's bounding rectangle
         x, y, w, h = cv2.boundingRect(self.contour)
@@ -79,7 +648,7 @@ class card:
 
         # Thresholding using Otsu's method
         #plt.hist(rank_img.ravel(),256,[0,256]); plt.show() # Check if the image is bimodal
-        (_, thresh) = cv2.threshold(rank_img_padded, 0, 255, cv2.THRESH_BINARY+cv2.THRESH_OTSU)
+        (thresh_level, thresh) = cv2.threshold(rank_img_padded, 0, 255, cv2.THRESH_BINARY+cv2.THRESH_OTSU)
         thresh = cv2.bitwise_not(thresh)
         #cv2.imshow("This card thresh", thresh); cv2.waitKey(0); cv2.destroyAllWindows()
 
@@ -96,31 +665,476 @@ class card:
             rank_crop = thresh[y1:y1+h1, x1:x1+w1]
 
             self.rank_img = cv2.resize(rank_crop, (RANK_WIDTH,RANK_HEIGHT), 0, 0)
+            self.rank_hu = hu_features(self.rank_img)
             #cv2.imshow("Cropped Rank", self.rank_img); cv2.waitKey(0); cv2.destroyAllWindows()
             #cv2.imwrite('img.png', self.rank_img)
 
+            # Crop the corner below the rank, and threshold it at the same level as the rank
+            if find_suit:
+                suit_img = self.img[y1+h1-5:SUIT_CORNER_HEIGHT, 0:CORNER_WIDTH]
+                suit_img_padded = np.pad(suit_img, 5, 'constant', constant_values=255)
+                (_, suit_thresh) = cv2.threshold(suit_img_padded, thresh_level, 255, cv2.THRESH_BINARY_INV)
+
+                # Get the bounding box around the largest contour and the pieces of the suit below and above it,
+                # and resize to the template size
+                (_, suit_cnts, _) = cv2.findContours(copy.deepcopy(suit_thresh), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+                if len(suit_cnts) != 0:
+                    largest = max(suit_cnts, key=cv2.contourArea)
+                    x2,y2,w2,h2 = cv2.boundingRect(largest)
+                    min_area = SUIT_PART_RATIO*cv2.contourArea(largest)
+                    parts = [c for c in suit_cnts if cv2.contourArea(c) >= min_area and rects_overlap(cv2.boundingRect(c), (x2, 0, w2, suit_thresh.shape[0]))]
+                    x2,y2,w2,h2 = cv2.boundingRect(np.vstack(parts))
+                    suit_crop = suit_thresh[y2:y2+h2, x2:x2+w2]
+                    self.suit_img = cv2.resize(suit_crop, (SUIT_WIDTH,SUIT_HEIGHT), 0, 0)
+                    #cv2.imshow("Cropped Suit", self.suit_img); cv2.waitKey(0); cv2.destroyAllWindows()
+
     def matchRank(self, all_ranks, match_method):
-        """ This function returns the best rank match of a given card image """
-        
-        # List to store rank match scores
-        match_scores = [];
+        """ This function returns the best rank match of a given card image.
+        The match method is a matcher, or the name of a registered matcher """
 
-        for i in range(len(all_ranks)):
-            if match_method is HU_MOMENTS:
-                # Compare contours of the card with the template       
-                match_scores.append(cv2.matchShapes(self.contour, all_ranks[i].contour, 1, 0.0))
-            
-            elif match_method is TEMPLATE_MATCHING:
-                # Difference the card with the template
-                diff_img = cv2.absdiff(self.rank_img, all_ranks[i].img)
-                match_scores.append(int(np.sum(diff_img)/255))    
-    
-        ind = np.argmin(match_scores)      
-        self.rank_score = match_scores[ind]
+        this_matcher = get_matcher(match_method, all_ranks)
+
+        match_scores = this_matcher.score([self])[0]
+        ind = int(np.argmin(match_scores))
+
+        self.rank_scores = match_scores
+        self.rank_score = match_scores[ind].item()
 
-        if self.rank_score < MAX_MATCH_SCORE:
+        if self.rank_score < this_matcher.max_score:
             self.best_rank_match = all_ranks[ind].name
 
+    def matchSuit(self, all_suits):
+        """ This function returns the best suit match of a given card image """
+
+        match_scores = score_suit_imgs(self.suit_img[np.newaxis], all_suits)[0]
+        ind = int(np.argmin(match_scores))
+        self.suit_score = match_scores[ind].item()
+
+        if self.suit_score < MAX_SUIT_SCORE:
+            self.best_suit_match = all_suits[ind].name
+
+### Matchers ###
+
+class matcher:
+    """Base structure for rank matching strategies. A matcher compiles its own representation of the
+    rank templates once, then scores a batch of cards against every rank in one call."""
+
+    max_score = MAX_MATCH_SCORE # Highest score at which a rank match is accepted
+    dtype = np.int64 # Type of the scores
+
+    def __init__(self, all_ranks):
+        self.compile(all_ranks)
+
+    def compile(self, all_ranks):
+        """ Build the representation of the rank templates that cards are scored against """
+
+        self.imgs = stack_ranks(all_ranks)
+
+    def score(self, all_cards):
+        """ Score the rank image of every card against every rank. Returns a (num_cards, num_ranks) array of scores """
+
+        raise NotImplementedError
+
+class template_matcher(matcher):
+    """Difference the rank images with every template at once."""
+
+    def score(self, all_cards):
+        rank_imgs = gather_rank_imgs(all_cards)
+
+        return sum_abs_diff(rank_imgs[:, np.newaxis], self.imgs[np.newaxis])//255
+
+class binary_matcher(matcher):
+    """Count the differing pixels of the binarized rank images and templates with XOR and popcount."""
+
+    def compile(self, all_ranks):
+        self.bits = pack_rank_imgs(stack_ranks(all_ranks))
+
+    def score(self, all_cards):
+        rank_bits = pack_rank_imgs(gather_rank_imgs(all_cards))
+        xor_bits = np.bitwise_xor(rank_bits[:, np.newaxis], self.bits[np.newaxis])
+
+        return np.sum(POPCOUNT_TABLE[xor_bits], axis=2, dtype=np.int64)
+
+class coarse_to_fine_matcher(matcher):
+    """Difference the rank images with downsampled templates, and keep the best candidates of each image
+    for full resolution differencing. Pruned ranks have the worst possible score."""
+
+    def __init__(self, all_ranks, num_candidates=COARSE_CANDIDATES):
+        self.num_candidates = min(num_candidates, len(all_ranks))
+        matcher.__init__(self, all_ranks)
+
+    def compile(self, all_ranks):
+        self.imgs = stack_ranks(all_ranks)
+        self.coarse_imgs = shrink_rank_imgs(self.imgs)
+
+    def score(self, all_cards):
+        rank_imgs = gather_rank_imgs(all_cards)
+
+        # Find the best candidates at low resolution
+        coarse_scores = sum_abs_diff(shrink_rank_imgs(rank_imgs)[:, np.newaxis], self.coarse_imgs[np.newaxis])
+        cand = np.argpartition(coarse_scores, self.num_candidates-1, axis=1)[:, :self.num_candidates]
+
+        # Difference only the candidates at full resolution
+        rows = np.arange(len(rank_imgs))[:, np.newaxis]
+        scores = np.full((len(rank_imgs), len(self.imgs)), RANK_HEIGHT*RANK_WIDTH, dtype=np.int64)
+        scores[rows, cand] = sum_abs_diff(rank_imgs[:, np.newaxis], self.imgs[cand])//255
+
+        return scores
+
+class early_abandon_matcher(matcher):
+    """Difference the rank images with the templates in blocks of rows, all at once. The template with the
+    best first block is differenced in full to bound each image's score, and every other template is
+    abandoned once its partial score can no longer beat that bound or MAX_MATCH_SCORE.
+    Abandoned ranks score one more than the best rank, or their partial score if that is higher."""
+
+    def __init__(self, all_ranks, block_rows=ABANDON_BLOCK_ROWS):
+        self.block_rows = block_rows
+        matcher.__init__(self, all_ranks)
+
+    def score(self, all_cards):
+        rank_imgs = gather_rank_imgs(all_cards)
+        rows = np.arange(len(rank_imgs))
+        block = self.block_rows
+
+        # Difference the first block of rows with every template
+        totals = sum_abs_diff(rank_imgs[:, np.newaxis, :block], self.imgs[np.newaxis, :, :block])
+
+        # Finish the most promising template of each image, to bound its score
+        seed = np.argmin(totals, axis=1)
+        totals[rows, seed] += sum_abs_diff(rank_imgs[:, block:], self.imgs[seed, block:])
+        bound = np.minimum(totals[rows, seed], MAX_MATCH_SCORE*255)
+
+        # Difference the rest of the rows block by block, only for pairs that can still beat the bound
+        active = totals < bound[:, np.newaxis]
+        active[rows, seed] = False
+        for row in range(block, RANK_HEIGHT, block):
+            (j, i) = np.nonzero(active)
+            if len(j) == 0:
+                break
+            totals[j, i] += sum_abs_diff(rank_imgs[j, row:row+block], self.imgs[i, row:row+block])
+            active[j, i] = totals[j, i] < bound[j]
+
+        # Pairs still active have been differenced in full, like the seeds. The rest were abandoned
+        active[rows, seed] = True
+        scores = totals//255
+        best = np.min(np.where(active, scores, np.iinfo(np.int64).max), axis=1)
+
+        return np.where(active, scores, np.maximum(scores, best[:, np.newaxis] + 1))
+
+class hu_matcher(matcher):
+    """Compare the log-scaled Hu moments of the rank images, computed once in processCard, by the sum of the
+    differences of their inverses, the CONTOURS_MATCH_I1 distance of cv2.matchShapes. Templates whose fill or centroid differ from the rank
+    image's score infinity, and cards whose best score is not clearly below the second best are pushed above
+    max_score."""
+
+    max_score = MAX_HU_SCORE
+    dtype = np.float64
+
+    def __init__(self, all_ranks, ratio=HU_RATIO):
+        self.ratio = ratio
+        matcher.__init__(self, all_ranks)
+
+    def compile(self, all_ranks):
+        self.hus = np.array([hu_features(all_ranks[i].img) for i in range(len(all_ranks))])
+
+    def score(self, all_cards):
+        features = np.array([this_card.rank_hu for this_card in all_cards])
+        (rank_hus, rank_layout) = (features[:, np.newaxis, :7], features[:, np.newaxis, 7:])
+        (hus, layout) = (self.hus[np.newaxis, :, :7], self.hus[np.newaxis, :, 7:])
+
+        # Sum the differences of the inverse moments, skipping moments either image has no value for
+        inv_rank_hus = np.divide(1.0, rank_hus, out=np.zeros(rank_hus.shape), where=rank_hus != 0)
+        inv_hus = np.divide(1.0, hus, out=np.zeros(hus.shape), where=hus != 0)
+        valid = (inv_rank_hus != 0) & (inv_hus != 0)
+
+        scores = np.sum(np.abs(inv_rank_hus - inv_hus)*valid, axis=2)
+
+        # Rule out templates laid out differently from the rank image
+        fill_diff = np.abs(rank_layout[..., 0] - layout[..., 0])
+        centroid_diff = np.max(np.abs(rank_layout[..., 1:] - layout[..., 1:]), axis=2)
+        scores[(fill_diff > HU_MAX_FILL_DIFF) | (centroid_diff > HU_MAX_CENTROID_DIFF)] = np.inf
+
+        # Reject the cards that are not clearly one rank
+        if scores.shape[1] > 1:
+            best_two = np.partition(scores, 1, axis=1)[:, :2]
+            scores[best_two[:, 0] > self.ratio*best_two[:, 1]] += self.max_score
+
+        return scores
+
+class pca_matcher(matcher):
+    """Project the rank images onto the principal components of the augmented templates, and find the
+    distance to the nearest projected template of every rank. The squared distance approximates the number
+    of differing pixels, but the nearest of the augmented copies is closer than the template itself, so
+    scores are lower than with TEMPLATE_MATCHING."""
+
+    max_score = MAX_PCA_SCORE
+    dtype = np.float64
+
+    def __init__(self, all_ranks, num_components=PCA_COMPONENTS):
+        self.num_components = num_components
+        matcher.__init__(self, all_ranks)
+
+    def compile(self, all_ranks):
+        aug_imgs, self.labels = augment_rank_imgs(stack_ranks(all_ranks))
+        samples = aug_imgs.reshape(len(aug_imgs), -1).astype(np.float32)/255
+
+        # Principal components are the top right singular vectors of the centered samples
+        self.mean = np.mean(samples, axis=0)
+        _, _, vt = np.linalg.svd(samples - self.mean, full_matrices=False)
+
+        self.basis = vt[:self.num_components]
+        self.embeddings = np.dot(samples - self.mean, self.basis.T)
+        self.num_ranks = len(all_ranks)
+
+    def score(self, all_cards):
+        rank_imgs = gather_rank_imgs(all_cards)
+        samples = rank_imgs.reshape(len(rank_imgs), -1).astype(np.float32)/255 - self.mean
+        embeddings = np.dot(samples, self.basis.T)
+
+        # Squared distance from every image to every projected template, plus the part of each image
+        # that the projection cannot represent
+        sq_norms = np.sum(embeddings**2, axis=1)
+        residuals = np.sum(samples**2, axis=1) - sq_norms
+        dists = (sq_norms[:, np.newaxis] - 2*np.dot(embeddings, self.embeddings.T)
+                 + np.sum(self.embeddings**2, axis=1)[np.newaxis] + residuals[:, np.newaxis])
+
+        # Keep the nearest projected image of each rank
+        scores = np.full((len(rank_imgs), self.num_ranks), np.inf)
+        for i in range(self.num_ranks):
+            scores[:, i] = np.min(dists[:, self.labels == i], axis=1)
+
+        return np.maximum(scores, 0)
+
+class gallery_matcher(matcher):
+    """Find the nearest rank images to each rank image in a KD-tree index of the downsampled templates,
+    and difference only those at full resolution. Ranks that are not among the nearest have the worst possible score."""
+
+    def __init__(self, all_ranks, num_neighbours=GALLERY_NEIGHBOURS):
+        self.num_neighbours = min(num_neighbours, len(all_ranks))
+        matcher.__init__(self, all_ranks)
+
+    def compile(self, all_ranks):
+        self.imgs = stack_ranks(all_ranks)
+
+        descriptors = shrink_rank_imgs(self.imgs).reshape(len(self.imgs), -1).astype(np.float32)
+        self.index = cv2.flann_Index(descriptors, dict(algorithm=FLANN_INDEX_KDTREE, trees=GALLERY_TREES))
+
+    def score(self, all_cards):
+        rank_imgs = gather_rank_imgs(all_cards)
+
+        # Find the nearest neighbours of the downsampled rank images
+        descriptors = shrink_rank_imgs(rank_imgs).reshape(len(rank_imgs), -1).astype(np.float32)
+        (cand, _) = self.index.knnSearch(descriptors, self.num_neighbours, params=dict(checks=GALLERY_CHECKS))
+
+        # Difference only the neighbours at full resolution
+        rows = np.arange(len(rank_imgs))[:, np.newaxis]
+        scores = np.full((len(rank_imgs), len(self.imgs)), RANK_HEIGHT*RANK_WIDTH, dtype=np.int64)
+        scores[rows, cand] = sum_abs_diff(rank_imgs[:, np.newaxis], self.imgs[cand])//255
+
+        return scores
+
+class chamfer_matcher(matcher):
+    """Score rank images with the symmetric chamfer distance: the mean distance from the edge pixels of
+    each rank image to the edges of each template, averaged with the mean distance the other way.
+    Scores are in pixels."""
+
+    max_score = MAX_CHAMFER_SCORE
+    dtype = np.float64
+
+    def compile(self, all_ranks):
+        self.edges = rank_edges(stack_ranks(all_ranks))
+        self.fields = distance_fields(self.edges)
+
+    def score(self, all_cards):
+        img_edges = rank_edges(gather_rank_imgs(all_cards))
+        img_fields = distance_fields(img_edges)
+
+        # Sample the template fields at the image edges, and the image fields at the template edges
+        img_to_rank = (np.sum(self.fields[np.newaxis]*img_edges[:, np.newaxis], axis=(2,3))
+                       / np.maximum(np.sum(img_edges, axis=(1,2)), 1)[:, np.newaxis])
+        rank_to_img = (np.sum(img_fields[:, np.newaxis]*self.edges[np.newaxis], axis=(2,3))
+                       / np.maximum(np.sum(self.edges, axis=(1,2)), 1)[np.newaxis])
+
+        return (img_to_rank + rank_to_img)/2
+
+class shift_matcher(matcher):
+    """Find the squared difference between the rank images and every template at every shift of up to
+    search pixels in each direction, and keep the best shift of each rank. The templates are padded and laid
+    side by side, so each card needs one cv2.matchTemplate call. Scores are divided by 255 squared, so they
+    count differing pixels like TEMPLATE_MATCHING."""
+
+    dtype = np.float64
+
+    def __init__(self, all_ranks, search=SHIFT_SEARCH):
+        self.search = search
+        matcher.__init__(self, all_ranks)
+
+    def compile(self, all_ranks):
+        k = self.search
+        imgs = stack_ranks(all_ranks)
+        self.num_ranks = len(imgs)
+
+        # Pad every template with background, and lay the templates side by side in one image
+        padded = np.pad(imgs, ((0,0), (k,k), (k,k)), 'constant', constant_values=0)
+        self.strip = np.hstack(padded).astype(np.float32)
+
+        # Columns of the matchTemplate result that are shifts of the card within one template
+        stride = RANK_WIDTH + 2*k
+        self.cols = (np.arange(self.num_ranks)[:, np.newaxis]*stride + np.arange(2*k+1)).ravel()
+
+        self.offsets = [] # Shift (dx, dy) of the last scored rank images from their best match with each rank
+
+    def score(self, all_cards):
+        k = self.search
+        scores = np.zeros((len(all_cards), self.num_ranks))
+        self.offsets = np.zeros((len(all_cards), self.num_ranks, 2), dtype=np.int64)
+
+        for j in range(len(all_cards)):
+            result = cv2.matchTemplate(self.strip, np.float32(all_cards[j].rank_img), cv2.TM_SQDIFF)
+
+            # Arrange the shifts as (rank, dy, dx), and keep the best of each rank
+            shifts = result[:, self.cols].reshape(2*k+1, self.num_ranks, 2*k+1).transpose(1,0,2).reshape(self.num_ranks, -1)
+            best = np.argmin(shifts, axis=1)
+            scores[j] = shifts[np.arange(self.num_ranks), best]/(255.0*255.0)
+            self.offsets[j, :, 0] = k - best % (2*k+1)
+            self.offsets[j, :, 1] = k - best // (2*k+1)
+
+        return scores
+
+class linear_matcher(matcher):
+    """Classify the downsampled rank images with a linear softmax classifier, in one matrix multiply for
+    the whole batch. Scores are one minus the probability of each rank, and images too far from every
+    template to be a rank score 1 for every rank. The weights are loaded from weights_path if they were
+    trained on the same ranks, or trained from the ranks otherwise."""
+
+    max_score = MAX_LINEAR_SCORE
+    dtype = np.float64
+
+    def __init__(self, all_ranks, weights_path=CLASSIFIER_PATH):
+        self.weights_path = weights_path
+        matcher.__init__(self, all_ranks)
+
+    def compile(self, all_ranks):
+        key = classifier_key(all_ranks)
+        loaded = None
+        if os.path.exists(self.weights_path):
+            loaded = load_classifier(self.weights_path)
+
+        if (loaded is not None) and (loaded[4] == key):
+            (self.weights, self.bias, self.mean, names, _) = loaded
+        else:
+            (self.weights, self.bias, self.mean, names) = train_classifier(all_ranks)
+
+        # Column of the classifier output for each rank, so galleries with several exemplars per rank work
+        names = list(names)
+        self.cols = np.array([names.index(all_ranks[i].name) for i in range(len(all_ranks))])
+
+        # Downsampled templates, to measure how far each image is from being any rank
+        self.features = classifier_features(stack_ranks(all_ranks))
+
+    def score(self, all_cards):
+        features = classifier_features(gather_rank_imgs(all_cards))
+        logits = np.dot(features - self.mean, self.weights) + self.bias
+        scores = 1 - softmax(logits)[:, self.cols]
+
+        # Reject images far from every template, which the classifier would still give to some rank
+        residual = np.min(np.mean(np.abs(features[:, np.newaxis] - self.features[np.newaxis]), axis=2), axis=1)
+        scores[residual > MAX_LINEAR_RESIDUAL] = 1.0
+
+        return scores
+
+class hog_matcher(matcher):
+    """Classify the HOG descriptors of the rank images with one-vs-rest linear SVMs trained on augmented
+    templates. The SVM weights are collected into one matrix, so a batch of cards is scored with one
+    matrix multiply. Scores are the raw SVM outputs, which are negative for a match."""
+
+    max_score = MAX_HOG_SCORE
+    dtype = np.float64
+
+    def __init__(self, all_ranks, num_copies=HOG_TRAIN_COPIES):
+        self.num_copies = num_copies
+        matcher.__init__(self, all_ranks)
+
+    def compile(self, all_ranks):
+        self.hog = cv2.HOGDescriptor((HOG_WIDTH, HOG_HEIGHT), (16,16), (8,8), (8,8), 9)
+
+        aug_imgs, labels = random_augment_rank_imgs(stack_ranks(all_ranks), self.num_copies)
+        features = hog_features(self.hog, aug_imgs)
+        names = np.array([all_ranks[i].name for i in range(len(all_ranks))])
+
+        self.weights = np.zeros((len(all_ranks), features.shape[1]), dtype=np.float32)
+        self.rho = np.zeros(len(all_ranks), dtype=np.float32)
+
+        for i in range(len(all_ranks)):
+            # Every exemplar of the rank is a positive sample
+            responses = np.int32(names[labels] == names[i])
+
+            svm = cv2.ml.SVM_create()
+            svm.setType(cv2.ml.SVM_C_SVC)
+            svm.setKernel(cv2.ml.SVM_LINEAR)
+            svm.setC(SVM_C)
+            svm.train(features, cv2.ml.ROW_SAMPLE, responses)
+
+            # A linear SVM keeps a single compressed support vector. Its raw output,
+            # alpha*sv.x - rho, is negative for the positive samples
+            (rho, alpha, _) = svm.getDecisionFunction(0)
+            self.weights[i] = alpha[0,0]*svm.getSupportVectors()[0]
+            self.rho[i] = rho
+
+    def score(self, all_cards):
+        features = hog_features(self.hog, gather_rank_imgs(all_cards))
+
+        return np.dot(features, self.weights.T) - self.rho
+
+class profile_matcher(matcher):
+    """Compare the row and column projection profiles of the rank images with those of the templates.
+    A card whose best profile distance is clearly below its second best is resolved from the profiles alone.
+    Other cards are differenced with every template like TEMPLATE_MATCHING. The profile distance is the mean
+    of the row and column L1 distances, which is never more than the number of differing pixels."""
+
+    dtype = np.float64
+
+    def __init__(self, all_ranks, ratio=PROFILE_RATIO):
+        self.ratio = ratio
+        matcher.__init__(self, all_ranks)
+
+    def compile(self, all_ranks):
+        self.imgs = stack_ranks(all_ranks)
+        self.profiles = projection_profiles(self.imgs)
+
+    def score(self, all_cards):
+        rank_imgs = gather_rank_imgs(all_cards)
+        profiles = projection_profiles(rank_imgs)
+        scores = np.sum(np.abs(profiles[:, np.newaxis] - self.profiles[np.newaxis]), axis=2)/2
+
+        # Difference the ambiguous cards at full resolution
+        if len(self.imgs) > 1:
+            best_two = np.partition(scores, 1, axis=1)[:, :2]
+            ambiguous = best_two[:, 0] > self.ratio*best_two[:, 1]
+        else:
+            ambiguous = np.zeros(len(rank_imgs), dtype=bool)
+
+        if np.any(ambiguous):
+            scores[ambiguous] = sum_abs_diff(rank_imgs[ambiguous][:, np.newaxis], self.imgs[np.newaxis])//255
+
+        return scores
+
+# Matcher classes, by name
+MATCHERS = {
+    TEMPLATE_MATCHING: template_matcher,
+    HU_MOMENTS: hu_matcher,
+    BINARY_MATCHING: binary_matcher,
+    COARSE_TO_FINE: coarse_to_fine_matcher,
+    EARLY_ABANDON: early_abandon_matcher,
+    PCA_MATCHING: pca_matcher,
+    GALLERY_MATCHING: gallery_matcher,
+    CHAMFER_MATCHING: chamfer_matcher,
+    SHIFT_MATCHING: shift_matcher,
+    LINEAR_MATCHING: linear_matcher,
+    HOG_MATCHING: hog_matcher,
+    PROFILE_MATCHING: profile_matcher,
+}
+
 ### Functions ###
 
 def main():
@@ -130,31 +1144,47 @@ def main():
     cap.set(cv2.CAP_PROP_FRAME_WIDTH,9999)
     cap.set(cv2.CAP_PROP_FRAME_HEIGHT,9999)
 
-    # Load the card rank images into a list of rank objects
+    # Load the card rank and suit images into lists of rank and suit objects
     rank_path = "card_images"
     ranks = load_ranks(rank_path)
+    suits = load_suits(rank_path)
+
+    # Cache of rank matches, since the same cards stay on the table for many frames
+    cache = rank_cache()
+
+    # Only look for cards again when something on the table has moved, and only process and match
+    # cards that are new or have moved
+    motion = motion_detector()
+    tracker = card_tracker()
+    all_cards = []
 
     while(True):
 
         # Get the next frame    
         flag, img = cap.read()
-        
-        # Get a list of all of the contours around cards
-        all_cards = findCards(img)
         img_disp = copy.deepcopy(img)
 
-        for i in range(len(all_cards)):
+        if motion.update(img):
+
+            # Get a list of all of the contours around cards
+            all_cards = findCards(img)
+            new_cards = tracker.update(all_cards)
 
-            # Produce a top-down image of each card
-            all_cards[i].processCard(img)
+            # Produce a top-down image of each new card
+            for i in range(len(new_cards)):
+                new_cards[i].processCard(img, find_suit=True)
 
-            # Find the best rank match for this card
-            all_cards[i].matchRank(ranks, TEMPLATE_MATCHING)
+            # Find the best rank and suit match for every new card at once
+            match_all(new_cards, ranks, cache=cache, all_suits=suits)
+
+        for i in range(len(all_cards)):
 
             # Draw on the temporary image
             cv2.drawContours(img_disp, [all_cards[i].contour], 0, (0,255,0), 2)
             text_pos = (all_cards[i].center[0], all_cards[i].center[1])
             cv2.putText(img_disp, all_cards[i].best_rank_match, text_pos, cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255,0,0), 1, cv2.LINE_AA)
+            suit_pos = (all_cards[i].center[0], all_cards[i].center[1]+20)
+            cv2.putText(img_disp, all_cards[i].best_suit_match, suit_pos, cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255,0,0), 1, cv2.LINE_AA)
         
         # Show the display image
         cv2.imshow("Detected Cards", img_disp)
@@ -167,11 +1197,83 @@ def main():
     cv2.destroyAllWindows()
 
 
-def findCards(image):
-    """ This function takes an images and returns a list of card objects with contour and corner info """
+def findCards(image, scale=1.0, refine_corners=False, roi=None, outer_only=False, workers=1):
+    """ This function takes an images and returns a list of card objects with contour and corner info.
+    If a table_roi is given, only the play area is cropped, masked and searched for cards.
+    With outer_only, contours nested inside another card are skipped, so each card is found once.
+    If scale is below 1, cards are found in a downscaled copy of the image and their contours and corners
+    are mapped back to full resolution. With refine_corners, each corner is then refined in the full
+    resolution image. With more than one worker, the image is searched in tiles on a pool of threads """
+
+    # Crop the image to the play area
+    x, y = 0, 0
+    mask = None
+    if roi is not None:
+        x, y, w, h = roi.rect
+        image_crop = image[y:y+h, x:x+w]
+        mask = roi.crop_mask
+    else:
+        image_crop = image
+
+    if scale >= 1.0:
+        card_info = detect_cards(image_crop, mask=mask, outer_only=outer_only, workers=workers)
+
+    else:
+        # Find the cards in a downscaled image, with the card area limits scaled to match
+        small = cv2.resize(image_crop, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        if mask is not None:
+            mask = cv2.resize(mask, (small.shape[1], small.shape[0]), interpolation=cv2.INTER_NEAREST)
+        card_info = detect_cards(small, CARD_MIN_AREA*scale*scale, CARD_MAX_AREA*scale*scale, mask, outer_only, workers=workers)
+
+        # Map the contours and corners back to full resolution
+        for this_card in card_info:
+            this_card.contour = np.int32(np.round(this_card.contour/scale))
+            this_card.corner_pts = this_card.corner_pts/scale
+
+    # Map the contours and corners back into the full image
+    for this_card in card_info:
+        this_card.contour = this_card.contour + np.int32([x, y])
+        this_card.corner_pts = this_card.corner_pts + np.float32([x, y])
+
+        if refine_corners and scale < 1.0:
+            this_card.corner_pts = refine_card_corners(image, this_card.corner_pts, int(np.ceil(1/scale)))
 
-    # List to store card objects
-    card_info = []
+    return card_info
+
+def refine_card_corners(image, corner_pts, radius):
+    """ Refine the corner points of a card to sub-pixel accuracy, searching within radius pixels of each.
+    Only a small patch of the image around each corner is converted and searched """
+
+    refined = np.copy(corner_pts)
+    patch_radius = 2*radius + 5
+
+    for i in range(len(corner_pts)):
+        x, y = int(corner_pts[i][0][0]), int(corner_pts[i][0][1])
+        x0, y0 = max(x - patch_radius, 0), max(y - patch_radius, 0)
+        patch = image[y0:y + patch_radius + 1, x0:x + patch_radius + 1]
+
+        # Skip corners too close to the image edge to search around
+        if min(patch.shape[:2]) < 2*radius + 5:
+            continue
+
+        gray = cv2.cvtColor(patch, cv2.COLOR_BGR2GRAY)
+        pt = np.float32([[corner_pts[i][0][0] - x0, corner_pts[i][0][1] - y0]])
+        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 20, 0.1)
+        pt = cv2.cornerSubPix(gray, pt.reshape(-1, 1, 2), (radius, radius), (-1, -1), criteria)
+        refined[i][0] = pt[0][0] + (x0, y0)
+
+    return refined
+
+def detect_cards(image, min_area=CARD_MIN_AREA, max_area=CARD_MAX_AREA, mask=None, outer_only=False, level=None, workers=1):
+    """ Find the contours of cards in an image, which have an area between min_area and max_area.
+    If a mask is given, only the pixels where it is nonzero are searched. With outer_only, contours
+    nested inside a card already found (inner borders, pips and glyphs) are not considered.
+    The threshold level is chosen with Otsu's method, unless a level is given.
+    With more than one worker, the image is searched in tiles on a pool of threads.
+    Returns a list of card objects with contour and corner info """
+
+    if workers > 1:
+        return detect_cards_threaded(image, min_area, max_area, mask, outer_only, level, workers)
 
     # Convert to grayscale
     gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)	
@@ -181,77 +1283,354 @@ def findCards(image):
 
     # Threshold with Otsu's method
     #plt.hist(blur.ravel(),256,[0,256]); plt.show() # Check if the image is bimodal
-    (_, thresh) = cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY+cv2.THRESH_OTSU)
+    if level is not None:
+        (_, thresh) = cv2.threshold(blur, level, 255, cv2.THRESH_BINARY)
+        if mask is not None:
+            thresh = cv2.bitwise_and(thresh, mask)
+    elif mask is None:
+        (_, thresh) = cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY+cv2.THRESH_OTSU)
+    else:
+        # Choose the threshold from the pixels inside the mask only, and clear everything outside it
+        (level, _) = cv2.threshold(blur[mask > 0].reshape(1, -1), 0, 255, cv2.THRESH_BINARY+cv2.THRESH_OTSU)
+        (_, thresh) = cv2.threshold(blur, level, 255, cv2.THRESH_BINARY)
+        thresh = cv2.bitwise_and(thresh, mask)
     #cv2.imshow("Thresholded playing area", thresh); cv2.waitKey(0); cv2.destroyAllWindows()
 
-    # Find contours and sort by size
-    (_, cnts, hier) = cv2.findContours(thresh, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-    index_sort = sorted(range(len(cnts)), key=lambda i : cv2.contourArea(cnts[i]),reverse=True)
+    return find_card_contours(thresh, min_area, max_area, outer_only)
+
+# Thread pools shared by every call to detect_cards_threaded, by number of workers
+thread_pools = {}
+
+def get_thread_pool(workers):
+    """ Return the thread pool with the given number of workers, starting it on first use """
+
+    if workers not in thread_pools:
+        thread_pools[workers] = ThreadPoolExecutor(max_workers=workers)
+
+    return thread_pools[workers]
+
+def detect_cards_threaded(image, min_area=CARD_MIN_AREA, max_area=CARD_MAX_AREA, mask=None, outer_only=False, level=None, workers=4):
+    """ Find the same cards as detect_cards, with the image split into overlapping tiles that are blurred,
+    thresholded and searched for contours on a pool of threads. The threshold level is chosen from the
+    histogram of the whole image. If a tile cannot hold the whole of a blob that starts in it, the image is
+    searched whole with detect_cards instead. Returns a list of card objects with contour and corner info """
+
+    (h, w) = image.shape[:2]
+    pad = 2 # Half the size of the Gaussian blur kernel
+
+    # Split the image into tiles which reach into the next tiles right and down, and one pixel into the
+    # previous tiles. Each tile keeps the cards whose bounding box starts in its core, which it holds the whole of
+    tiles = []
+    for y in range(0, h, THREAD_TILE_SIZE):
+        for x in range(0, w, THREAD_TILE_SIZE):
+            core = (x, y, min(THREAD_TILE_SIZE, w-x), min(THREAD_TILE_SIZE, h-y))
+            (x0, y0) = (max(x-1, 0), max(y-1, 0))
+            size = THREAD_TILE_SIZE + THREAD_TILE_OVERLAP
+            tiles.append((core, (x0, y0, min(x+size, w)-x0, min(y+size, h)-y0)))
+
+    def blur_tile(tile):
+        """ Convert and blur a tile along with a border of its surroundings, so it matches the same
+        part of the whole blurred image, and count the pixel values in its core """
+
+        (core, (x, y, tw, th)) = tile
+        (x0, y0) = (max(x-pad, 0), max(y-pad, 0))
+        gray = cv2.cvtColor(image[y0:min(y+th+pad, h), x0:min(x+tw+pad, w)], cv2.COLOR_BGR2GRAY)
+        blur = cv2.GaussianBlur(gray, (5,5), 0)[y-y0:y-y0+th, x-x0:x-x0+tw]
+
+        (cx, cy, cw, ch) = core
+        core_mask = None if mask is None else mask[cy:cy+ch, cx:cx+cw]
+        hist = cv2.calcHist([blur[cy-y:cy-y+ch, cx-x:cx-x+cw]], [0], core_mask, [256], [0, 256])
+
+        return (blur, hist)
+
+    def search_tile(tile, blur):
+        """ Threshold a tile and find the cards it keeps, in the coordinates of the whole image.
+        Also returns whether a blob starting in the core runs past the edge of the tile """
+
+        (core, (x, y, tw, th)) = tile
+        (_, thresh) = cv2.threshold(blur, level, 255, cv2.THRESH_BINARY)
+        if mask is not None:
+            thresh = cv2.bitwise_and(thresh, mask[y:y+th, x:x+tw])
+
+        # No other tile holds the start of such a blob, so a card in it would be lost. Blobs already larger
+        # than a card, like the table border, are not cards whatever lies past the edge
+        too_big = False
+        (_, cnts, hier) = cv2.findContours(thresh, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+        for c in cnts:
+            rect = cv2.boundingRect(c)
+            if (rect_cut_off(rect, (x, y, tw, th), (h, w)) and rects_overlap((x+rect[0], y+rect[1], 1, 1), core)
+                    and cv2.contourArea(c) <= max_area):
+                too_big = True
+                break
+
+        card_info = []
+        for this_card in find_card_contours(thresh, min_area, max_area, outer_only, (cnts, hier)):
+            rect = cv2.boundingRect(this_card.contour)
+            if rect_cut_off(rect, (x, y, tw, th), (h, w)) or not rects_overlap((x+rect[0], y+rect[1], 1, 1), core):
+                continue
+            this_card.contour = this_card.contour + np.int32([x, y])
+            this_card.corner_pts = this_card.corner_pts + np.float32([x, y])
+            card_info.append(this_card)
+
+        return (card_info, too_big)
+
+    pool = get_thread_pool(workers)
+    (blurs, hists) = zip(*pool.map(blur_tile, tiles))
+    if level is None:
+        level = otsu_level(np.sum(hists, axis=0))
+    (tile_cards, too_big) = zip(*pool.map(search_tile, tiles, blurs))
+
+    if any(too_big):
+        return detect_cards(image, min_area, max_area, mask, outer_only, level)
+
+    card_info = [c for this_tile in tile_cards for c in this_tile]
+
+    # Order the cards as detect_cards does: by area, then in the order findContours reaches them
+    card_info.sort(key=lambda c : (-cv2.contourArea(c.contour), c.contour[0][0][1], c.contour[0][0][0]))
 
-    # Catch cases where no contours were detected
-    try:
+    return card_info
 
-        # Initialize empty sorted contour and hierarchy lists
-        cnts_sort = []
-        hier_sort = []
+def otsu_level(hist):
+    """ Choose a threshold level from a 256 bin histogram with Otsu's method, as cv2.threshold does """
 
-        # Fill empty lists with sorted contour and sorted hierarchy. 
-        for i in index_sort:
-            cnts_sort.append(cnts[i])
-            hier_sort.append(hier[0][i])  
+    p = np.float64(hist).ravel()/np.sum(hist)
+    i = np.arange(256)
+    q1 = np.cumsum(p)
+    q2 = 1.0 - q1
+    m1 = np.cumsum(i*p)
+    mu = m1[-1]
 
-        # Determine which of the contours are cards    
-        for i in range(len(cnts_sort)):
+    # Between class variance of each level, skipping levels with (almost) all pixels on one side
+    valid = (np.minimum(q1, q2) >= np.finfo(np.float32).eps) & (np.maximum(q1, q2) <= 1.0 - np.finfo(np.float32).eps)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sigma = q1*q2*(m1/q1 - (mu - m1)/q2)**2
+    sigma[~valid] = 0
 
-            # Get the size of the cards
-            size = cv2.contourArea(cnts_sort[i])
+    return float(np.argmax(sigma))
 
-            # Use the perimeter of the card to set the accuracy parameter of the polymetric approximation
-            peri = cv2.arcLength(cnts_sort[i],True)
-            accuracy = POLY_ACC_CONST*peri    
+def find_card_contours(thresh, min_area=CARD_MIN_AREA, max_area=CARD_MAX_AREA, outer_only=False, contours=None):
+    """ Find the contours of cards in a thresholded image, which have an area between min_area and max_area.
+    The contours and hierarchy found in the image with RETR_TREE can be given, if they already have been.
+    Returns a list of card objects with contour and corner info """
 
-            # Approximate the shape of the contours            
-            approx = cv2.approxPolyDP(cnts_sort[i], accuracy, True)
+    # List to store card objects
+    card_info = []
+
+    # Find contours, compute each area once, and sort the contours by area
+    if contours is None:
+        (_, cnts, hier) = cv2.findContours(thresh, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    else:
+        (cnts, hier) = contours
+    areas = np.array([cv2.contourArea(c) for c in cnts])
+    index_sort = np.argsort(-areas, kind='stable')
+
+    # Indices of the contours accepted as cards
+    card_idx = set()
+
+    # Determine which of the contours are cards
+    for i in index_sort:
+
+        # Get the size of the cards, skipping contours that are too large and stopping at
+        # the first one that is too small, since all the rest are smaller
+        size = areas[i]
+        if size >= max_area:
+            continue
+        if size <= min_area:
+            break
 
-            # Cards are determined to have an area within a given range,
-            # have 4 corners and have no parents
-            if ((size < CARD_MAX_AREA) and (size > CARD_MIN_AREA) 
-                and (len(approx) == 4)):# and (hier_sort[i][3] == -1)):                
-                new_card = card()
-                new_card.contour = cnts_sort[i]  
-                new_card.corner_pts = np.float32(approx)
+        # Skip contours inside a card already found. Parents are at least as large as their
+        # children, so any card containing this contour has already been visited
+        if outer_only:
+            parent = hier[0][i][3]
+            while (parent != -1) and (parent not in card_idx):
+                parent = hier[0][parent][3]
+            if parent != -1:
+                continue
+
+        # Use the perimeter of the card to set the accuracy parameter of the polymetric approximation
+        peri = cv2.arcLength(cnts[i],True)
+        accuracy = POLY_ACC_CONST*peri
+
+        # Approximate the shape of the contours
+        approx = cv2.approxPolyDP(cnts[i], accuracy, True)
+
+        # Cards are determined to have an area within a given range,
+        # have 4 corners and have no parents
+        if (len(approx) == 4):# and (hier[0][i][3] == -1)):
+            new_card = card()
+            new_card.contour = cnts[i]
+            new_card.corner_pts = np.float32(approx)
+
+            # Add the new card to the list
+            card_info.append(new_card)
+            card_idx.add(i)
+
+            ### Debugging ###
+            """
+            print('size = {}, acc = {}, numCorners = {}'.format(size, accuracy, len(approx)))
+            temp_img = cv2.cvtColor(thresh, cv2.COLOR_GRAY2BGR)
+            cv2.drawContours(temp_img, cnts, i, (0,255,0), 3)
+            cv2.imshow("This Card Contour", temp_img); cv2.waitKey(0); cv2.destroyAllWindows()
+            """
 
-                # Add the new card to the list
-                card_info.append(new_card)
+    return card_info
 
-                ### Debugging ###
-                """
-                print('size = {}, acc = {}, numCorners = {}'.format(size, accuracy, len(approx)))
-                temp_img = copy.deepcopy(image)
-                cv2.drawContours(temp_img, cnts_sort, i, (0,255,0), 3)
-                cv2.imshow("This Card Contour", temp_img); cv2.waitKey(0); cv2.destroyAllWindows()
-                """
+def roi_from_polygon(pts, image_shape):
+    """ Make a table_roi covering the inside of a polygon, for camera images of a given shape """
 
-    # If there are no contours, do nothing
-    except:
-        pass
+    mask = np.zeros(image_shape[:2], dtype=np.uint8)
+    cv2.fillPoly(mask, [np.int32(pts).reshape(-1, 1, 2)], 255)
 
-    return card_info
+    return table_roi(mask)
+
+def load_roi(path, image_shape=None):
+    """ Load a table_roi from a mask image, where nonzero pixels are the play area, or from a text
+    file of polygon points with one 'x y' pair per line. Polygons need the camera image shape """
+
+    if os.path.splitext(path)[1].lower() in ('.png', '.bmp', '.jpg', '.jpeg', '.tif', '.tiff'):
+        return table_roi(cv2.imread(path, cv2.IMREAD_GRAYSCALE))
+
+    return roi_from_polygon(np.loadtxt(path, ndmin=2), image_shape)
+
+def rects_overlap(a, b):
+    """ Check whether two (x, y, w, h) rectangles overlap """
+
+    return (a[0] < b[0]+b[2]) and (b[0] < a[0]+a[2]) and (a[1] < b[1]+b[3]) and (b[1] < a[1]+a[3])
+
+def quad_iou(pts1, pts2):
+    """ Find the intersection over union of the areas inside two sets of convex corner points """
+
+    pts1 = np.float32(pts1).reshape(-1, 2)
+    pts2 = np.float32(pts2).reshape(-1, 2)
+    (inter, _) = cv2.intersectConvexConvex(pts1, pts2)
+    union = cv2.contourArea(pts1) + cv2.contourArea(pts2) - inter
+
+    return inter/union if union > 0 else 0.0
+
+def rect_cut_off(rect, region, image_shape):
+    """ Check whether an (x, y, w, h) rectangle in the coordinates of a region touches an edge of the
+    region that is not also an edge of an image of the given shape """
+
+    (x, y, w, h) = region
+    return (((rect[0] == 0) and (x > 0)) or ((rect[1] == 0) and (y > 0))
+            or ((rect[0]+rect[2] == w) and (x+w < image_shape[1])) or ((rect[1]+rect[3] == h) and (y+h < image_shape[0])))
+
+def cut_blobs(thresh, region, image_shape):
+    """ Find the bounding boxes, in the whole image, of the blobs in a thresholded (x, y, w, h) region of an
+    image of the given shape that are cut off by the edge of the region. Blobs reaching the edge of the
+    image, like the table border, are left out """
+
+    (x, y) = (region[0], region[1])
+    (_, cnts, _) = cv2.findContours(copy.deepcopy(thresh), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    blobs = []
+    for c in cnts:
+        (cx, cy, cw, ch) = cv2.boundingRect(c)
+        if ((x+cx == 0) or (y+cy == 0) or (x+cx+cw == image_shape[1]) or (y+cy+ch == image_shape[0])):
+            continue
+        if rect_cut_off((cx, cy, cw, ch), region, image_shape):
+            blobs.append((x+cx, y+cy, cw, ch))
+
+    return blobs
+
+def rect_holds(region, rect, image_shape):
+    """ Check whether a region of an image of the given shape holds the whole of an (x, y, w, h) rectangle,
+    so that a card with that bounding box is found whole when the region is searched on its own """
+
+    (x, y) = (region[0], region[1])
+    return (rect_inside(rect, region)
+            and not rect_cut_off((rect[0]-x, rect[1]-y, rect[2], rect[3]), region, image_shape))
+
+def rect_inside(a, b):
+    """ Check whether (x, y, w, h) rectangle a lies wholly inside rectangle b """
+
+    return (a[0] >= b[0]) and (a[1] >= b[1]) and (a[0]+a[2] <= b[0]+b[2]) and (a[1]+a[3] <= b[1]+b[3])
+
+def tile_rect(rect, tile_size, image_shape):
+    """ Convert an (x, y, w, h) rectangle in tiles to pixels, clipped to an image of the given shape """
+
+    x, y = rect[0]*tile_size, rect[1]*tile_size
+    return (x, y, min(rect[2]*tile_size, image_shape[1]-x), min(rect[3]*tile_size, image_shape[0]-y))
+
+def tile_cover(rect, tile_size, image_shape):
+    """ Find the (x, y, w, h) rectangle in pixels of the tiles under a rectangle and one tile around them,
+    clipped to an image of the given shape """
+
+    (tx0, ty0) = (max(rect[0]//tile_size-1, 0), max(rect[1]//tile_size-1, 0))
+    (tx1, ty1) = ((rect[0]+rect[2]-1)//tile_size+2, (rect[1]+rect[3]-1)//tile_size+2)
+
+    return tile_rect((tx0, ty0, tx1-tx0, ty1-ty0), tile_size, image_shape)
+
+def merge_rects(rects):
+    """ Merge overlapping (x, y, w, h) rectangles into their bounding rectangles, until none overlap """
+
+    rects = list(rects)
+    i = 0
+    while i < len(rects):
+        for j in range(i+1, len(rects)):
+            if rects_overlap(rects[i], rects[j]):
+                (a, b) = (rects[i], rects.pop(j))
+                x, y = min(a[0], b[0]), min(a[1], b[1])
+                rects[i] = (x, y, max(a[0]+a[2], b[0]+b[2])-x, max(a[1]+a[3], b[1]+b[3])-y)
+                break
+        else:
+            i += 1
+            continue
+        # Check the merged rectangle against all the others again
+        i = 0
+
+    return rects
 
 def load_ranks(path):
     """ Load rank images from a specified path. Store rank images in a list of rank objects """
 
-    ranks = []
-    rank_names = ['Ace', 'Two', 'Three', 'Four', 'Five', 'Six', 'Seven', 'Eight', 'Nine', 'Ten', 'Jack', 'Queen', 'King']
+    img_paths = [os.path.join(path, name+'.png') for name in RANK_NAMES]
+
+    return read_ranks(RANK_NAMES, img_paths)
 
-    for name in rank_names:
+def load_gallery(path):
+    """ Load any number of rank images per rank from a specified path and its subdirectories, such as one
+    subdirectory per deck design. Images are named after their rank, optionally followed by an underscore
+    and a tag (Ace.png, Ace_2.png). Store rank images in a list of rank objects """
+
+    rank_names = []
+    img_paths = []
+    decks = []
+
+    for (root, dirs, files) in os.walk(path):
+        dirs.sort()
+
+        for file_name in sorted(files):
+            (stem, ext) = os.path.splitext(file_name)
+            name = stem.split('_')[0]
+
+            if ext.lower() == '.png' and name in RANK_NAMES:
+                rank_names.append(name)
+                img_paths.append(os.path.join(root, file_name))
+                decks.append(os.path.relpath(root, path) if root != path else "")
+
+    ranks = read_ranks(rank_names, img_paths)
+    for i in range(len(ranks)):
+        ranks[i].deck = decks[i]
+
+    return ranks
+
+def read_ranks(rank_names, img_paths):
+    """ Read a rank image for each rank name. Store rank images in a list of rank objects """
+
+    ranks = rank_list()
+
+    # Preallocate one array to hold every rank image
+    ranks.imgs = np.zeros((len(rank_names), RANK_HEIGHT, RANK_WIDTH), dtype=np.uint8)
+
+    for i, name in enumerate(rank_names):
 
         # Create a new instance of the rank class
         new_rank = rank()
 
-        # Read the image of the rank
-        img_path = os.path.join(path, name+'.png')
-        new_rank.img = cv2.imread(img_path, cv2.IMREAD_GRAYSCALE)
+        # Read the image of the rank into the stacked array, and keep a view of it
+        ranks.imgs[i] = cv2.imread(img_paths[i], cv2.IMREAD_GRAYSCALE)
+        new_rank.img = ranks.imgs[i]
 
         # Store the name
         new_rank.name = name
@@ -274,6 +1653,365 @@ def load_ranks(path):
 
     return ranks
 
+def load_suits(path):
+    """ Load suit images from a specified path. Store suit images in a list of suit objects """
+
+    suits = suit_list()
+    suits.imgs = np.zeros((len(SUIT_NAMES), SUIT_HEIGHT, SUIT_WIDTH), dtype=np.uint8)
+
+    for i, name in enumerate(SUIT_NAMES):
+
+        # Read the image of the suit into the stacked array, and keep a view of it
+        new_suit = suit()
+        suits.imgs[i] = cv2.imread(os.path.join(path, name+'.png'), cv2.IMREAD_GRAYSCALE)
+        new_suit.img = suits.imgs[i]
+        new_suit.name = name
+
+        suits.append(new_suit)
+
+    return suits
+
+def save_suits(path, all_suits):
+    """ Save the suit images of a list of suit objects where load_suits reads them from """
+
+    for this_suit in all_suits:
+        cv2.imwrite(os.path.join(path, this_suit.name+'.png'), this_suit.img)
+
+def fit_suits(suit_imgs, all_suits, max_score=MAX_SUIT_SCORE):
+    """ Fit suit templates to a (num_imgs, SUIT_HEIGHT, SUIT_WIDTH) array of suit images from cards.
+    Each image scoring under max_score is labelled with its best matching template, and each new template is
+    the thresholded mean of the images of its suit. Suits no image matched keep their template.
+    Returns a new list of suit objects """
+
+    scores = score_suit_imgs(suit_imgs, all_suits)
+    best = np.argmin(scores, axis=1)
+    matched = np.min(scores, axis=1) < max_score
+
+    suits = suit_list()
+    suits.imgs = np.array(all_suits.imgs)
+
+    for i in range(len(all_suits)):
+        if np.any(matched & (best == i)):
+            mean = np.mean(suit_imgs[matched & (best == i)], axis=0)
+            suits.imgs[i] = np.where(mean > 127, 255, 0)
+
+        new_suit = suit()
+        new_suit.img = suits.imgs[i]
+        new_suit.name = all_suits[i].name
+        suits.append(new_suit)
+
+    return suits
+
+def stack_ranks(all_ranks):
+    """ Return the rank images of a list of rank objects as one (num_ranks, RANK_HEIGHT, RANK_WIDTH) array """
+
+    # Rank lists from load_ranks already hold the stacked images
+    if isinstance(all_ranks, rank_list) and len(all_ranks.imgs) == len(all_ranks):
+        return all_ranks.imgs
+
+    imgs = np.zeros((len(all_ranks), RANK_HEIGHT, RANK_WIDTH), dtype=np.uint8)
+    for i in range(len(all_ranks)):
+        imgs[i] = all_ranks[i].img
+
+    return imgs
+
+def score_suit_imgs(suit_imgs, all_suits):
+    """ Difference a (num_imgs, SUIT_HEIGHT, SUIT_WIDTH) array of suit images with every suit template.
+    Returns a (num_imgs, num_suits) array of scores """
+
+    return sum_abs_diff(suit_imgs[:, np.newaxis], all_suits.imgs[np.newaxis])//255
+
+def sum_abs_diff(imgs1, imgs2):
+    """ Sum the absolute difference of two broadcastable stacks of uint8 images over their last two axes """
+
+    # Absolute difference without leaving uint8, then one reduction over each pair of images
+    diff_imgs = np.maximum(imgs1, imgs2) - np.minimum(imgs1, imgs2)
+
+    return np.sum(diff_imgs, axis=(-2,-1), dtype=np.int64)
+
+def pack_rank_imgs(rank_imgs):
+    """ Binarize a (num_imgs, RANK_HEIGHT, RANK_WIDTH) array of rank images and pack 8 pixels per byte.
+    Returns a (num_imgs, num_bytes) array """
+
+    return np.packbits(rank_imgs.reshape(len(rank_imgs), -1) > 127, axis=1)
+
+def shrink_rank_imgs(rank_imgs):
+    """ Downsample a (num_imgs, RANK_HEIGHT, RANK_WIDTH) array of rank images by COARSE_SCALE """
+
+    size = (RANK_WIDTH//COARSE_SCALE, RANK_HEIGHT//COARSE_SCALE)
+    coarse_imgs = np.zeros((len(rank_imgs), size[1], size[0]), dtype=np.uint8)
+    for i in range(len(rank_imgs)):
+        coarse_imgs[i] = cv2.resize(rank_imgs[i], size, interpolation=cv2.INTER_AREA)
+
+    return coarse_imgs
+
+def hu_features(rank_img):
+    """ Return the log-scaled Hu moments of a rank image, with every pixel set or not, followed by the
+    fraction of its pixels that are set and its centroid as a fraction of its width and height.
+    Moments too small to compare are set to zero """
+
+    moments = cv2.moments(rank_img, True)
+    hu = cv2.HuMoments(moments).ravel()
+
+    log_hu = np.zeros(len(hu))
+    valid = np.abs(hu) > 1e-5
+    log_hu[valid] = np.sign(hu[valid])*np.log10(np.abs(hu[valid]))
+
+    (height, width) = rank_img.shape
+    area = max(moments['m00'], 1)
+    layout = [moments['m00']/(width*height), moments['m10']/area/width, moments['m01']/area/height]
+
+    return np.concatenate([log_hu, layout])
+
+def augment_rank_imgs(rank_imgs, shifts=AUGMENT_SHIFTS, scales=AUGMENT_SCALES):
+    """ Make shifted and scaled copies of a (num_imgs, RANK_HEIGHT, RANK_WIDTH) array of rank images.
+    Returns the copies and the index of the rank image each copy was made from """
+
+    center = (RANK_WIDTH/2, RANK_HEIGHT/2)
+    aug_imgs = []
+    labels = []
+
+    for i in range(len(rank_imgs)):
+        for scale in scales:
+            for dx in shifts:
+                for dy in shifts:
+                    M = cv2.getRotationMatrix2D(center, 0, scale)
+                    M[:, 2] += (dx, dy)
+                    aug_imgs.append(cv2.warpAffine(rank_imgs[i], M, (RANK_WIDTH, RANK_HEIGHT)))
+                    labels.append(i)
+
+    return np.array(aug_imgs, dtype=np.uint8), np.array(labels)
+
+def random_augment_rank_imgs(rank_imgs, num_copies, seed=0):
+    """ Make randomly shifted, scaled, blurred and noisy copies of a (num_imgs, RANK_HEIGHT, RANK_WIDTH) array
+    of rank images. Returns the copies and the index of the rank image each copy was made from """
+
+    rng = np.random.RandomState(seed)
+    center = (RANK_WIDTH/2, RANK_HEIGHT/2)
+    aug_imgs = np.zeros((len(rank_imgs)*num_copies, RANK_HEIGHT, RANK_WIDTH), dtype=np.uint8)
+    labels = np.repeat(np.arange(len(rank_imgs)), num_copies)
+
+    for j in range(len(aug_imgs)):
+        M = cv2.getRotationMatrix2D(center, 0, rng.uniform(0.85, 1.15))
+        M[:, 2] += rng.uniform(-3, 3, size=2)
+        aug_img = cv2.warpAffine(rank_imgs[labels[j]], M, (RANK_WIDTH, RANK_HEIGHT))
+
+        aug_img = cv2.GaussianBlur(aug_img, (5,5), rng.uniform(0.1, 1.5))
+        aug_img = aug_img + rng.normal(0, 20, size=aug_img.shape)
+        aug_imgs[j] = np.clip(aug_img, 0, 255)
+
+    return aug_imgs, labels
+
+def classifier_features(rank_imgs):
+    """ Return the downsampled rank images as (num_imgs, num_features) rows scaled to [0, 1] """
+
+    return shrink_rank_imgs(rank_imgs).reshape(len(rank_imgs), -1)/255.0
+
+def softmax(logits):
+    """ Return the softmax of each row of logits """
+
+    exps = np.exp(logits - np.max(logits, axis=1, keepdims=True))
+
+    return exps/np.sum(exps, axis=1, keepdims=True)
+
+def train_classifier(all_ranks, num_copies=TRAIN_COPIES, num_iterations=TRAIN_ITERATIONS, seed=0):
+    """ Fit a linear softmax classifier to augmented copies of the rank images with gradient descent.
+    Returns the weights, the bias, the mean feature vector and the name of each class """
+
+    # One class per rank name, so several exemplars of a rank are trained as the same class
+    names = [name for name in RANK_NAMES if name in [all_ranks[i].name for i in range(len(all_ranks))]]
+    rank_classes = np.array([names.index(all_ranks[i].name) for i in range(len(all_ranks))])
+
+    aug_imgs, labels = random_augment_rank_imgs(stack_ranks(all_ranks), num_copies, seed)
+    features = classifier_features(aug_imgs)
+    mean = np.mean(features, axis=0)
+    features = features - mean
+    targets = np.eye(len(names))[rank_classes[labels]]
+
+    weights = np.zeros((features.shape[1], len(names)))
+    bias = np.zeros(len(names))
+
+    for _ in range(num_iterations):
+        # Gradient of the mean cross entropy loss, with weight decay
+        grad = (softmax(np.dot(features, weights) + bias) - targets)/len(features)
+        weights -= TRAIN_STEP*(np.dot(features.T, grad) + TRAIN_DECAY*weights)
+        bias -= TRAIN_STEP*np.sum(grad, axis=0)
+
+    return weights.astype(np.float32), bias.astype(np.float32), mean.astype(np.float32), np.array(names)
+
+def classifier_key(all_ranks):
+    """ Return a digest of the names and images of a list of ranks, identifying the ranks a classifier was trained on """
+
+    digest = hashlib.sha1()
+    for i in range(len(all_ranks)):
+        digest.update(all_ranks[i].name.encode())
+    digest.update(np.ascontiguousarray(stack_ranks(all_ranks)).tobytes())
+
+    return digest.hexdigest()
+
+def save_classifier(path, weights, bias, mean, names, key):
+    """ Save linear classifier weights to a file, along with the classifier_key of the ranks they were trained on """
+
+    np.savez_compressed(path, weights=weights, bias=bias, mean=mean, names=names, key=key)
+
+def load_classifier(path):
+    """ Load linear classifier weights from a file. Returns the weights, the bias, the mean feature vector,
+    the name of each class and the key of the ranks they were trained on, which is None for older files """
+
+    data = np.load(path)
+    key = str(data['key']) if 'key' in data else None
+
+    return data['weights'], data['bias'], data['mean'], data['names'], key
+
+def hog_features(hog, rank_imgs):
+    """ Compute the HOG descriptors of a (num_imgs, RANK_HEIGHT, RANK_WIDTH) array of rank images in one call.
+    Returns a (num_imgs, descriptor_size) array """
+
+    # Stack the resized images into one tall image, each with a reflected border so its gradients
+    # are the same as if it were computed alone
+    tall = np.vstack([cv2.copyMakeBorder(cv2.resize(rank_imgs[i], (HOG_WIDTH, HOG_HEIGHT)), 1, 1, 1, 1, cv2.BORDER_REFLECT_101)
+                      for i in range(len(rank_imgs))])
+    locations = tuple((1, 1 + i*(HOG_HEIGHT+2)) for i in range(len(rank_imgs)))
+
+    return hog.compute(tall, (8,8), (0,0), locations).reshape(len(rank_imgs), -1)
+
+def projection_profiles(rank_imgs):
+    """ Return the row sums followed by the column sums of a (num_imgs, RANK_HEIGHT, RANK_WIDTH) array of
+    rank images, in pixels. Returns a (num_imgs, RANK_HEIGHT+RANK_WIDTH) array """
+
+    rows = np.sum(rank_imgs, axis=2, dtype=np.int64)
+    cols = np.sum(rank_imgs, axis=1, dtype=np.int64)
+
+    return np.hstack((rows, cols))/255.0
+
+def rank_edges(rank_imgs):
+    """ Return boolean masks of the edge pixels of a (num_imgs, RANK_HEIGHT, RANK_WIDTH) array of rank images """
+
+    kernel = np.ones((3,3), dtype=np.uint8)
+    edges = np.zeros(rank_imgs.shape, dtype=bool)
+
+    # Edge pixels are the glyph pixels removed by eroding the glyph
+    for i in range(len(rank_imgs)):
+        glyph = np.uint8(rank_imgs[i] > 127)
+        edges[i] = (glyph - cv2.erode(glyph, kernel)) > 0
+
+    return edges
+
+def distance_fields(edges):
+    """ Return the distance from every pixel to the nearest edge pixel, for a stack of edge masks """
+
+    # Images without edges are as far from an edge as possible everywhere
+    fields = np.full(edges.shape, np.hypot(edges.shape[1], edges.shape[2]), dtype=np.float32)
+    for i in range(len(edges)):
+        if np.any(edges[i]):
+            fields[i] = cv2.distanceTransform(np.where(edges[i], 0, 255).astype(np.uint8), cv2.DIST_L2, 3)
+
+    return fields
+
+def hash_rank_img(rank_img):
+    """ Return a perceptual hash of a rank image: which pixels of the downsampled image are above its mean """
+
+    small = cv2.resize(rank_img, (HASH_WIDTH, HASH_HEIGHT), interpolation=cv2.INTER_AREA)
+
+    return np.packbits(small > np.mean(small)).tobytes()
+
+def register_matcher(name, matcher_class):
+    """ Make a matcher class selectable by name """
+
+    MATCHERS[name] = matcher_class
+
+def get_matcher(match_method, all_ranks):
+    """ Return a matcher compiled for a list of ranks. The match method is a matcher, or the name of a
+    registered matcher. Matchers compiled for a rank_list are kept with it, so each is only compiled once """
+
+    if isinstance(match_method, matcher):
+        return match_method
+
+    if match_method not in MATCHERS:
+        raise ValueError("Unknown match method {}".format(match_method))
+
+    if not isinstance(all_ranks, rank_list):
+        return MATCHERS[match_method](all_ranks)
+
+    if match_method not in all_ranks.matchers:
+        all_ranks.matchers[match_method] = MATCHERS[match_method](all_ranks)
+
+    return all_ranks.matchers[match_method]
+
+def gather_rank_imgs(all_cards):
+    """ Return the rank images of a list of cards as one (num_cards, RANK_HEIGHT, RANK_WIDTH) array """
+
+    rank_imgs = np.zeros((len(all_cards), RANK_HEIGHT, RANK_WIDTH), dtype=np.uint8)
+    for i in range(len(all_cards)):
+        rank_imgs[i] = all_cards[i].rank_img
+
+    return rank_imgs
+
+def match_all(all_cards, all_ranks, match_method=TEMPLATE_MATCHING, cache=None, all_suits=None):
+    """ Find the best rank match for every card in a frame in one operation.
+    The match method is a matcher, or the name of a registered matcher.
+    If a rank_cache is given, cards with a rank image the same matcher has already matched reuse that match.
+    If suits from load_suits are given, the suit of every card processed with find_suit is matched in the same call.
+    Returns a (num_cards, num_ranks) array of scores. Rows of cards without a rank image are -1 """
+
+    if all_suits is not None:
+        match_suits(all_cards, all_suits)
+
+    this_matcher = get_matcher(match_method, all_ranks)
+    scores = np.full((len(all_cards), len(all_ranks)), -1, dtype=this_matcher.dtype)
+
+    # Gather the rank images of every processed card
+    inds = [i for i in range(len(all_cards)) if len(all_cards[i].rank_img) != 0]
+
+    # Reuse the matches of rank images seen in earlier frames
+    if cache is not None:
+        hits = [i for i in inds if cache.lookup(all_cards[i], this_matcher)]
+        for i in hits:
+            scores[i] = all_cards[i].rank_scores
+        inds = [i for i in inds if i not in hits]
+
+    if len(inds) == 0:
+        return scores
+
+    # Score every card against every rank
+    scores[inds] = this_matcher.score([all_cards[i] for i in inds])
+
+    best = np.argmin(scores[inds], axis=1)
+
+    # Store the best match of each card
+    for j, i in enumerate(inds):
+        all_cards[i].rank_scores = scores[i]
+        all_cards[i].rank_score = scores[i, best[j]].item()
+
+        if all_cards[i].rank_score < this_matcher.max_score:
+            all_cards[i].best_rank_match = all_ranks[best[j]].name
+
+        if cache is not None:
+            cache.store(all_cards[i], this_matcher)
+
+    return scores
+
+def match_suits(all_cards, all_suits):
+    """ Find the best suit match for every card with a suit image in one operation """
+
+    inds = [i for i in range(len(all_cards)) if len(all_cards[i].suit_img) != 0]
+    if len(inds) == 0:
+        return
+
+    suit_imgs = np.zeros((len(inds), SUIT_HEIGHT, SUIT_WIDTH), dtype=np.uint8)
+    for j, i in enumerate(inds):
+        suit_imgs[j] = all_cards[i].suit_img
+
+    scores = score_suit_imgs(suit_imgs, all_suits)
+    best = np.argmin(scores, axis=1)
+
+    # Store the best match of each card
+    for j, i in enumerate(inds):
+        all_cards[i].suit_score = int(scores[j, best[j]])
+
+        if all_cards[i].suit_score < MAX_SUIT_SCORE:
+            all_cards[i].best_suit_match = all_suits[best[j]].name
+
 def flattener(image, pts, w, h):
     """Flattens an image of a card into a top-down 200x300 perspective.
     Returns the flattened, re-sized, grayed image.
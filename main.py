@@ -12,8 +12,9 @@ font = cv2.FONT_HERSHEY_SIMPLEX
 
 ### Main code body
 
-# Load the card rank images into a list of rank objects
+# Load the card rank and suit images into lists of rank and suit objects
 ranks = cards.load_ranks(rank_path)
+suits = cards.load_suits(rank_path)
 
 # Get next image of playing area
 img = cv2.imread(os.path.join('game_images', 'transformed_small2.png'))
@@ -22,18 +23,21 @@ img_disp = copy.deepcopy(img)
 # Get a list of all of the contours around cards
 all_cards = cards.findCards(img)
 
+# Produce a top-down image of each card
 for i in range(len(all_cards)):
+    all_cards[i].processCard(img, find_suit=True)
 
-    # Produce a top-down image of each card
-    all_cards[i].processCard(img)
+# Find the best rank and suit match for every card at once
+cards.match_all(all_cards, ranks, all_suits=suits)
 
-    # Find the best rank match for this card
-    all_cards[i].matchRank(ranks, cards.TEMPLATE_MATCHING)
+for i in range(len(all_cards)):
 
     # Draw on the temporary image
     cv2.drawContours(img_disp, [all_cards[i].contour], 0, (0,255,0), 2)
     text_pos = (all_cards[i].center[0], all_cards[i].center[1])
     cv2.putText(img_disp, all_cards[i].best_rank_match, text_pos, font, 0.5, (255,0,0), 1, cv2.LINE_AA)
+    suit_pos = (all_cards[i].center[0], all_cards[i].center[1]+20)
+    cv2.putText(img_disp, all_cards[i].best_suit_match, suit_pos, font, 0.5, (255,0,0), 1, cv2.LINE_AA)
 
 # Show the display image    
 cv2.imshow("Detected Cards", img_disp); cv2.waitKey(0); cv2.destroyAllWindows()
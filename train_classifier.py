@@ -0,0 +1,19 @@
+""" This program trains the linear rank classifier from the card rank images and saves its weights """
+
+### Import necessary packages
+import cards
+
+### Constants
+rank_path = "card_images"
+
+### Main code body
+
+# Load the card rank images into a list of rank objects
+ranks = cards.load_ranks(rank_path)
+
+# Fit the classifier to augmented copies of the rank images
+weights, bias, mean, names = cards.train_classifier(ranks)
+
+# Save the weights where the linear matcher loads them from
+cards.save_classifier(cards.CLASSIFIER_PATH, weights, bias, mean, names, cards.classifier_key(ranks))
+print('Saved rank classifier to {}'.format(cards.CLASSIFIER_PATH))
@@ -0,0 +1,32 @@
+""" This program refits the suit images to the suits of the cards in the game images and saves them """
+
+### Import necessary packages
+import os
+import cv2
+import numpy as np
+import cards
+
+### Constants
+suit_path = "card_images"
+game_path = "game_images"
+
+### Main code body
+
+# Load the current suit images, which label the suits of the cards
+suits = cards.load_suits(suit_path)
+
+# Crop the suit of every card in the game images
+suit_imgs = []
+for file_name in sorted(os.listdir(game_path)):
+    img = cv2.imread(os.path.join(game_path, file_name))
+
+    all_cards = cards.findCards(img)
+    for i in range(len(all_cards)):
+        all_cards[i].processCard(img, find_suit=True)
+
+    suit_imgs += [this_card.suit_img for this_card in all_cards if len(this_card.suit_img) != 0]
+
+# Average the crops of each suit, and save them where load_suits reads them from
+suits = cards.fit_suits(np.array(suit_imgs), suits)
+cards.save_suits(suit_path, suits)
+print('Saved suit images fitted to {} cards to {}'.format(len(suit_imgs), suit_path))